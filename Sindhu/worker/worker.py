@@ -1,10 +1,13 @@
 import os
-import json
 import time
+import random
+import msgspec
 import logging
 import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 import redis.asyncio as redis
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from datetime import datetime
 from bson import ObjectId
 
@@ -22,9 +25,44 @@ DATABASE_NAME = os.getenv("DATABASE_NAME", "order_management")
 # Redis connection
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))  # seconds to wait for a free connection
 
 # Worker configuration
 PROCESSING_DELAY = int(os.getenv("PROCESSING_DELAY", 5))  # seconds
+SUCCESS_RATE = 0.9  # 90% of orders succeed in the simulation
+QUEUE_BATCH_SIZE = int(os.getenv("QUEUE_BATCH_SIZE", 32))  # orders per pop
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 32))  # orders in flight
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", 0.05))  # seconds between status writes
+FLUSH_BATCH_SIZE = int(os.getenv("FLUSH_BATCH_SIZE", 500))  # status updates per write
+
+# Sorted set of orders being fulfilled, scored by when their marker expires
+PROCESSING_KEY = "processing_orders"
+
+
+class QueueMsg(msgspec.Struct):
+    """Order message popped from the Redis processing queue"""
+    order_id: str
+    item_name: str
+    quantity: int
+
+
+# MessagePack decoder for queue messages
+_dec = msgspec.msgpack.Decoder(QueueMsg)
+
+# JSON decoder for messages queued by API versions that predate MessagePack
+_legacy_dec = msgspec.json.Decoder(QueueMsg)
+
+
+def decode_message(message: bytes) -> QueueMsg:
+    """Decode a queue message, falling back to the legacy JSON format"""
+    try:
+        return _dec.decode(message)
+    except msgspec.DecodeError:
+        return _legacy_dec.decode(message)
+
+# JSON encoder for order events published to subscribers
+_event_enc = msgspec.json.Encoder()
 
 
 class OrderWorker:
@@ -33,8 +71,15 @@ class OrderWorker:
     def __init__(self):
         self.mongodb_client = None
         self.database = None
+        self.redis_pool = None
         self.redis_client = None
+        self.queue_client = None
         self.running = False
+        self._sem = asyncio.Semaphore(WORKER_CONCURRENCY)
+        self._tasks = set()
+        self._pending_updates = {}
+        self._flush_lock = asyncio.Lock()
+        self._flusher_task = None
     
     async def connect(self):
         """Establish connections to MongoDB and Redis"""
@@ -47,11 +92,21 @@ class OrderWorker:
             await self.mongodb_client.admin.command('ping')
             logger.info("Successfully connected to MongoDB")
             
-            # Connect to Redis
-            self.redis_client = redis.Redis(
+            # Connect to Redis (raw bytes, msgspec decodes them directly)
+            self.redis_pool = redis.BlockingConnectionPool(
                 host=REDIS_HOST,
                 port=REDIS_PORT,
-                decode_responses=True
+                decode_responses=False,
+                # Every in-flight order may need a connection, plus the queue and flusher
+                max_connections=max(REDIS_MAX_CONNECTIONS, WORKER_CONCURRENCY + 2),
+                timeout=REDIS_POOL_TIMEOUT
+            )
+            self.redis_client = redis.Redis(connection_pool=self.redis_pool)
+            
+            # Dedicated connection for blocking queue reads
+            self.queue_client = redis.Redis(
+                connection_pool=self.redis_pool,
+                single_connection_client=True
             )
             await self.redis_client.ping()
             logger.info("Successfully connected to Redis")
@@ -68,16 +123,25 @@ class OrderWorker:
             self.mongodb_client.close()
             logger.info("MongoDB connection closed")
         
+        if self.queue_client:
+            await self.queue_client.close()
+        
         if self.redis_client:
             await self.redis_client.close()
+        
+        if self.redis_pool:
+            await self.redis_pool.disconnect()
             logger.info("Redis connection closed")
     
     async def update_order_status(self, order_id: str, status: str):
-        """Update order status in MongoDB"""
+        """Queue an order status update for the next bulk write to MongoDB"""
         try:
-            now = datetime.utcnow().isoformat()
+            now = datetime.utcnow()
+            # BSON dates keep milliseconds, truncate so stored and returned values match
+            now = now.replace(microsecond=now.microsecond // 1000 * 1000)
             
-            result = await self.database.orders.update_one(
+            # Keyed by order so a newer status replaces a pending older one
+            self._pending_updates[order_id] = UpdateOne(
                 {"_id": ObjectId(order_id)},
                 {
                     "$set": {
@@ -86,86 +150,203 @@ class OrderWorker:
                     }
                 }
             )
+            logger.info(f"Order {order_id} status update to {status} queued")
             
-            if result.modified_count > 0:
-                logger.info(f"Order {order_id} status updated to {status}")
-                return True
-            else:
-                logger.warning(f"Order {order_id} not found for status update")
-                return False
+            if len(self._pending_updates) >= FLUSH_BATCH_SIZE:
+                await self.flush_updates()
+            return True
                 
         except Exception as e:
             logger.error(f"Error updating order {order_id}: {e}")
             return False
     
-    async def process_order(self, order_data: dict):
+    async def flush_updates(self):
+        """Write all pending status updates to MongoDB in one bulk operation"""
+        async with self._flush_lock:
+            if not self._pending_updates:
+                return
+            
+            order_ids = list(self._pending_updates)
+            batch = list(self._pending_updates.values())
+            self._pending_updates = {}
+            failed = set()
+            
+            try:
+                result = await self.database.orders.bulk_write(batch, ordered=False)
+                logger.info(f"Flushed {len(batch)} status update(s), {result.modified_count} modified")
+                
+                if result.matched_count < len(batch):
+                    logger.warning(f"{len(batch) - result.matched_count} order(s) not found for status update")
+                    
+            except BulkWriteError as e:
+                failed = {error["index"] for error in e.details.get("writeErrors", [])}
+                logger.error(f"Error flushing {len(failed)} of {len(batch)} status update(s): {e}")
+            except Exception as e:
+                failed = set(range(len(batch)))
+                logger.error(f"Error flushing {len(batch)} status update(s): {e}")
+            
+            # Requeue failed updates for the next flush, keeping any newer status
+            for index in failed:
+                self._pending_updates.setdefault(order_ids[index], batch[index])
+            
+            written = [order_id for index, order_id in enumerate(order_ids) if index not in failed]
+            
+            # Drop cached API responses and processing markers so readers see the new status,
+            # and trim markers left behind by orders that never finished
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    if written:
+                        pipe.delete(*(f"order:{order_id}" for order_id in written))
+                        pipe.zrem(PROCESSING_KEY, *written)
+                    pipe.zremrangebyscore(PROCESSING_KEY, "-inf", time.time())
+                    await pipe.execute()
+            except Exception as e:
+                logger.error(f"Error invalidating cached orders: {e}")
+    
+    async def _flusher(self):
+        """Periodically flush pending status updates"""
+        while self.running:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush_updates()
+    
+    async def process_order(self, order_data: QueueMsg):
         """
         Process a single order
         Simulates order fulfillment with a delay
         """
-        order_id = order_data.get("order_id")
-        item_name = order_data.get("item_name")
-        quantity = order_data.get("quantity")
+        order_id = order_data.order_id
+        item_name = order_data.item_name
+        quantity = order_data.quantity
         
         logger.info(f"Processing order {order_id}: {quantity}x {item_name}")
         
+        # Mark the order as in progress in Redis, only the final status goes to MongoDB.
+        # The API reports marked pending orders as processing until the marker expires
+        try:
+            expires_at = time.time() + PROCESSING_DELAY + 30
+            await self.redis_client.zadd(PROCESSING_KEY, {order_id: expires_at})
+        except Exception as e:
+            logger.warning(f"Error marking order {order_id} as processing: {e}")
+        
         try:
-            # Update status to processing
-            await self.update_order_status(order_id, "processing")
-            
             # Simulate order processing (e.g., inventory check, payment, shipping)
             logger.info(f"Fulfilling order {order_id}... (this takes {PROCESSING_DELAY} seconds)")
             await asyncio.sleep(PROCESSING_DELAY)
             
             # Randomly simulate success/failure for demonstration
-            import random
-            success_rate = 0.9  # 90% success rate
-            
-            if random.random() < success_rate:
+            if random.random() < SUCCESS_RATE:
                 # Order fulfilled successfully
-                await self.update_order_status(order_id, "completed")
+                status = "completed"
                 logger.info(f"Order {order_id} completed successfully")
             else:
                 # Order failed (e.g., out of stock)
-                await self.update_order_status(order_id, "failed")
+                status = "failed"
                 logger.warning(f"Order {order_id} failed during processing")
             
         except Exception as e:
             logger.error(f"Error processing order {order_id}: {e}")
-            await self.update_order_status(order_id, "failed")
+            status = "failed"
+        
+        await self.update_order_status(order_id, status)
+        
+        # Count the outcome and announce it in one round-trip, the processing marker
+        # is cleared once the status has been flushed to MongoDB
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.incr(f"stats:{status}")
+                pipe.publish("order_events", _event_enc.encode({"id": order_id, "status": status}))
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error publishing outcome for order {order_id}: {e}")
+    
+    async def handle_message(self, message: bytes):
+        """Decode a raw queue message and process the order"""
+        try:
+            order_data = decode_message(message)
+            await self.process_order(order_data)
+        except msgspec.DecodeError as e:
+            logger.error(f"Invalid queue message: {e}")
+        except Exception as e:
+            logger.error(f"Error processing queue message: {e}")
+    
+    async def _run(self, message: bytes):
+        """Handle a message and release its concurrency slot"""
+        try:
+            await self.handle_message(message)
+        finally:
+            self._sem.release()
+    
+    async def acquire_slots(self) -> int:
+        """Wait for a free slot, then claim any other free slots up to a batch"""
+        await self._sem.acquire()
+        slots = 1
+        while slots < QUEUE_BATCH_SIZE and not self._sem.locked():
+            await self._sem.acquire()
+            slots += 1
+        return slots
+    
+    def dispatch(self, message: bytes):
+        """Process a message in the background, the task owns one acquired slot"""
+        task = asyncio.create_task(self._run(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
     
     async def start(self):
         """Start the worker to consume from the queue"""
         self.running = True
+        self._flusher_task = asyncio.create_task(self._flusher())
         logger.info("Worker started, waiting for orders...")
         
         while self.running:
             try:
-                # Block and wait for an order from the queue
-                result = await self.redis_client.brpop("order_queue", timeout=5)
+                # Only pop as many orders as can start right away, so none wait locally
+                slots = await self.acquire_slots()
                 
-                if result:
-                    queue_name, message = result
-                    logger.info(f"Received order from queue: {message}")
+                try:
+                    # Drain up to the free slots in a single round-trip
+                    messages = await self.queue_client.rpop("order_queue", slots)
                     
-                    try:
-                        order_data = json.loads(message)
-                        await self.process_order(order_data)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Invalid JSON in queue message: {e}")
-                    except Exception as e:
-                        logger.error(f"Error processing queue message: {e}")
-                else:
-                    logger.debug("No orders in queue, waiting...")
+                    if not messages:
+                        # Queue is empty, keep one slot and block until the next order arrives
+                        for _ in range(slots - 1):
+                            self._sem.release()
+                        slots = 1
+                        
+                        queue_name, message = await self.queue_client.brpop("order_queue", timeout=0)
+                        messages = [message]
                     
+                    logger.info(f"Received {len(messages)} order(s) from queue")
+                    for message in messages:
+                        self.dispatch(message)
+                        slots -= 1
+                        
+                finally:
+                    # Return slots that did not get an order
+                    for _ in range(slots):
+                        self._sem.release()
+                    
+            except redis.ConnectionError as e:
+                # The pool reconnects on the next command, back off briefly first
+                logger.error(f"Lost connection to Redis: {e}")
+                await asyncio.sleep(1)
             except Exception as e:
+                # Back off so a persistent error (e.g. a wrong key type) doesn't spin the loop
                 logger.error(f"Error in worker loop: {e}")
-                await asyncio.sleep(5) 
+                await asyncio.sleep(1)
     
     async def stop(self):
         """Stop the worker gracefully"""
         logger.info("Stopping worker...")
         self.running = False
+        
+        # Let in-flight orders finish
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        
+        # The flusher exits after its current flush now that running is False
+        if self._flusher_task:
+            await self._flusher_task
+        await self.flush_updates()
 
 
 async def main():